@@ -1,16 +1,68 @@
 import os
 import logging
+import multiprocessing
+import threading
+import queue
+import uuid
+from datetime import datetime
+from typing import Dict, Any
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+import orjson
 from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from db_connector import db
-from forecaster import engine
+from db_connector import get_db
+from forecaster import engine, USE_PROPHET
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (numpy-aware, much faster than stdlib json)."""
+
+    OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=str, option=self.OPTIONS).decode()  # default: ObjectId etc.
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return orjson.loads(s)
 
 # Initialize Flask & Logging
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("AI_Service_API")
 
+# Streaming batch sizes
+PREDICT_CHUNK_SIZE = 100  # Products preprocessed & forecast together (matches the Mongo cursor batch)
+WRITE_CHUNK_SIZE = 500    # Pending updates flushed per bulk write
+WRITE_QUEUE_SIZE = 1000   # Max predictions waiting for the writer thread
+
+# Background batch jobs (in-process registry; run gunicorn with a single worker)
+MAX_TRACKED_JOBS = 100
+_JOBS: Dict[str, Dict[str, Any]] = {}
+_JOBS_LOCK = threading.Lock()
+
+# Worker pool for CPU-bound model fitting (created lazily, shared across requests)
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Returns the shared process pool, spawning workers on first use."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # forkserver: never fork the threaded server process (gthread, writer & pymongo threads)
+            _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver"))
+            logger.info(f"⚙️ Forecast pool started with {os.cpu_count()} workers.")
+        return _POOL
+
+def _chunked(iterable, size):
+    """Yields lists of up to `size` items from any iterable."""
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
 @app.route('/', methods=['GET'])
 def health_check():
     return jsonify({
@@ -19,64 +71,157 @@ def health_check():
         "version": "2.0 (Enterprise)"
     }), 200
 
-@app.route('/predict/batch', methods=['POST'])
-def run_batch_prediction():
+def _update_job(job_id: str, **fields):
+    with _JOBS_LOCK:
+        _JOBS[job_id].update(fields)
+
+def _drain_to_mongo(q: queue.Queue, db, counters: Dict[str, Any]):
+    """
+    Writer thread: consumes (id, prediction) pairs and flushes them in bulk writes
+    while forecasting continues. A `None` item signals the end of the batch.
+    On a write failure the error is recorded in `counters["error"]` and the queue
+    keeps being drained (and discarded) so the producer never blocks.
+    """
+    updates = []
+    while True:
+        item = q.get()
+        if item is not None and counters["error"] is None:
+            pid, prediction = item
+            updates.append({"_id": pid, "prediction": prediction})
+
+        if updates and (item is None or len(updates) >= WRITE_CHUNK_SIZE):
+            try:
+                counters["updated"] += db.bulk_update_predictions(updates)
+            except Exception as e:
+                logger.error(f"Batch Write Failed: {e}")
+                counters["error"] = str(e)
+            updates = []
+
+        if item is None:
+            return
+
+def _run_batch_job(job_id: str, include_series: bool = True):
     """
     High-Performance Batch Job:
-    1. Fetches data in bulk (Aggregation)
-    2. Generates forecasts (Prophet)
-    3. Writes back in bulk (BulkWrite)
+    1. Streams data in bulk (Aggregation cursor)
+    2. Generates forecasts (Holt-Winters in-process / Prophet parallel across CPU cores)
+    3. Writes back in bulk (BulkWrite) from a writer thread, overlapping with step 2;
+       30-day series unless `include_series` is off
     """
     try:
-        logger.info("🚀 Starting Batch Prediction Job...")
+        logger.info(f"🚀 Starting Batch Prediction Job {job_id}...")
+        _update_job(job_id, status="running", started_at=datetime.utcnow().isoformat())
         
-        # 1. Fetch optimized batch
+        db = get_db()
+
+        # 1. Stream optimized batch (forecasting starts as soon as the first chunk arrives)
         products = db.fetch_training_batch(limit=2000)
-        if not products:
-            return jsonify({"message": "No products with sufficient history found."}), 200
 
-        updates = []
+        processed = 0
+        counters = {"updated": 0, "error": None}
         stats = {"uptrend": 0, "downtrend": 0, "critical": 0}
 
-        # 2. Iterate and Predict
-        for p in products:
-            pid = p['_id']
-            name = p.get('name', 'Unknown')
-            current_qty = p.get('quantity', 0)
-            history = p.get('history', [])
-            
-            # Generate Forecast
-            prediction = engine.generate_forecast(current_qty, history)
-            
-            if prediction['status'] == 'success':
-                # Add to bulk update list
-                updates.append({
-                    "_id": pid,
-                    "prediction": prediction
-                })
-                
-                # Update realtime stats
-                if prediction.get('trend') == 'uptrend': stats['uptrend'] += 1
-                if prediction.get('trend') == 'downtrend': stats['downtrend'] += 1
-                if prediction.get('stock_out_date'): stats['critical'] += 1
-
-        # 3. Bulk Write to DB (The "Pro" Move)
-        if updates:
-            db.bulk_update_predictions(updates)
-
-        return jsonify({
-            "success": True,
-            "processed": len(products),
-            "updated": len(updates),
-            "insights": stats,
-            "message": "Batch analysis complete"
-        }), 200
+        # 3. Bulk Write to DB concurrently (The "Pro" Move)
+        write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer = threading.Thread(target=_drain_to_mongo, args=(write_queue, db, counters), daemon=True)
+        writer.start()
+
+        try:
+            for chunk in _chunked(products, PREDICT_CHUNK_SIZE):
+                if counters["error"]:
+                    break  # Writer failed: stop forecasting, the job is reported as failed
+                processed += len(chunk)
+
+                # 2. Preprocess the chunk at once, then predict (cached histories are skipped)
+                tasks = engine.prepare_batch(chunk)
+                # Only Prophet fits are slow enough to pay for pickling work across processes
+                pool = _get_pool() if USE_PROPHET else None
+                results = engine.generate_batch(tasks, pool=pool, include_series=include_series)
+
+                # Aggregate on the main process
+                for pid, prediction in results:
+                    if prediction['status'] == 'success':
+                        # Hand off to the writer thread
+                        write_queue.put((pid, prediction))
+                        
+                        # Update realtime stats
+                        if prediction.get('trend') == 'uptrend': stats['uptrend'] += 1
+                        if prediction.get('trend') == 'downtrend': stats['downtrend'] += 1
+                        if prediction.get('stock_out_date'): stats['critical'] += 1
+        finally:
+            # Flush whatever is pending, even if forecasting failed midway
+            write_queue.put(None)
+            writer.join()
+
+        if counters["error"]:
+            raise RuntimeError(f"Writing predictions failed: {counters['error']}")
+
+        updated = counters["updated"]
+        message = "Batch analysis complete" if processed else "No products with sufficient history found."
+        _update_job(
+            job_id,
+            status="completed",
+            finished_at=datetime.utcnow().isoformat(),
+            result={
+                "processed": processed,
+                "updated": updated,
+                "insights": stats,
+                "message": message
+            }
+        )
+        logger.info(f"✅ Batch Prediction Job {job_id} complete: {updated}/{processed} updated.")
 
     except Exception as e:
         logger.error(f"Batch Job Failed: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        _update_job(job_id, status="failed", finished_at=datetime.utcnow().isoformat(), error=str(e))
+
+@app.route('/predict/batch', methods=['POST'])
+def run_batch_prediction():
+    """
+    Starts the batch job in a background thread and returns immediately (202 Accepted).
+    Poll /predict/batch/status/<job_id> for progress and results.
+    The 30-day series is stored in ai_forecast.forecast_data (read by ForecastChart);
+    pass ?include_series=0 to skip it when only the summary fields are needed.
+    """
+    include_series = request.args.get("include_series", "1") != "0"
+    job_id = uuid.uuid4().hex
+    with _JOBS_LOCK:
+        # One batch at a time: a second run would re-forecast and overwrite the same products
+        active = next((jid for jid, job in _JOBS.items() if job["status"] in ("queued", "running")), None)
+        if active:
+            return jsonify({
+                "success": False,
+                "job_id": active,
+                "status_url": f"/predict/batch/status/{active}",
+                "error": "A batch job is already in progress"
+            }), 409
+
+        # Forget the oldest finished jobs once the registry is full
+        finished = [jid for jid, job in _JOBS.items() if job["status"] in ("completed", "failed")]
+        for jid in finished[:max(0, len(_JOBS) - MAX_TRACKED_JOBS + 1)]:
+            del _JOBS[jid]
+        _JOBS[job_id] = {"job_id": job_id, "status": "queued", "submitted_at": datetime.utcnow().isoformat()}
+
+    threading.Thread(target=_run_batch_job, args=(job_id, include_series), daemon=True).start()
+
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status_url": f"/predict/batch/status/{job_id}",
+        "message": "Batch analysis started"
+    }), 202
+
+@app.route('/predict/batch/status/<job_id>', methods=['GET'])
+def batch_prediction_status(job_id: str):
+    with _JOBS_LOCK:
+        job = dict(_JOBS[job_id]) if job_id in _JOBS else None
+
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown job id"}), 404
+    return jsonify({"success": True, **job}), 200
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5002))
     logger.info(f"🧠 AI Service starting on port {port}...")
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=port, debug=bool(int(os.environ.get("FLASK_DEBUG", "0"))))
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
 import logging
 import time
-from typing import List, Dict, Optional, Any
+import threading
+from typing import List, Dict, Optional, Any, Iterator
 from pymongo import MongoClient, UpdateOne
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, BulkWriteError
 from datetime import datetime
@@ -10,27 +11,50 @@ from datetime import datetime
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger("DB_Connector")
 
+# Server-side pre-filter: products with steady demand and ample stock skip forecasting
+DAY_MS = 24 * 60 * 60 * 1000
+STABLE_RATIO_BAND = (0.9, 1.1)   # Week-over-week sales ratio considered "stable"
+DAYS_OF_COVER_THRESHOLD = 45     # Stock covering fewer days than this is worth forecasting
+FORECAST_TTL_DAYS = 7            # Skipped products are still re-forecast at least this often
+
+BULK_WRITE_CHUNK_SIZE = 500  # Operations per bulk_write round-trip
+
+def _sales_since(start_days_ago: int, end_days_ago: int) -> Dict[str, Any]:
+    """Aggregation expression: sum of history sales in [now - start, now - end)."""
+    # Same field fallbacks as the training $project and the forecaster
+    event_date = {"$convert": {"input": {"$ifNull": ["$$h.date", "$$h.createdAt"]}, "to": "date", "onError": None, "onNull": None}}
+    return {
+        "$sum": {
+            "$map": {
+                "input": {
+                    "$filter": {
+                        "input": "$history",
+                        "as": "h",
+                        "cond": {"$and": [
+                            {"$gte": [event_date, {"$subtract": ["$$NOW", start_days_ago * DAY_MS]}]},
+                            {"$lt": [event_date, {"$subtract": ["$$NOW", end_days_ago * DAY_MS]}]}
+                        ]}
+                    }
+                },
+                "as": "h",
+                "in": {"$ifNull": ["$$h.sales", {"$ifNull": ["$$h.quantity_sold", 0]}]}
+            }
+        }
+    }
+
 class DatabaseConnectionError(Exception):
     """Custom Exception for DB Failures"""
     pass
 
 class DBConnector:
-    _instance = None
-
-    def __new__(cls):
-        """Singleton Pattern to ensure one connection pool."""
-        if cls._instance is None:
-            cls._instance = super(DBConnector, cls).__new__(cls)
-            cls._instance._initialize()
-        return cls._instance
-
-    def _initialize(self):
+    def __init__(self):
         """Initializes the MongoDB Connection with Retry Logic."""
         self.uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/smart_inventory")
         self.db_name = self.uri.split("/")[-1] or "smart_inventory"
         self.client = None
         self.db = None
         self._connect_with_retry()
+        self._ensure_indexes()
 
     def _connect_with_retry(self, retries=3, delay=2):
         for attempt in range(retries):
@@ -51,65 +75,148 @@ class DBConnector:
         logger.critical("❌ Could not connect to MongoDB after multiple attempts.")
         raise DatabaseConnectionError("Failed to connect to MongoDB.")
 
-    def fetch_training_batch(self, limit: int = 1000) -> List[Dict[str, Any]]:
+    def _ensure_indexes(self):
+        """Creates the indexes used by the training pipeline (no-op if they exist)."""
+        try:
+            # Sparse: only products with a non-empty history are indexed
+            self.db.products.create_index([("history.0", 1)], sparse=True, name="history_nonempty")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not ensure indexes: {e}")
+
+    def fetch_training_batch(self, limit: int = 1000, skip_stable: bool = True) -> Iterator[Dict[str, Any]]:
         """
-        Fetches a batch of products optimized for training.
+        Streams a batch of products optimized for training.
+        Yields documents straight off the cursor so compute overlaps with IO.
         Uses Projection to fetch ONLY necessary fields (save bandwidth).
+        With `skip_stable`, products with flat week-over-week demand and plenty of
+        stock are filtered out inside MongoDB, unless their forecast is missing,
+        older than FORECAST_TTL_DAYS, or has a stock-out date in the past.
         """
         try:
             # Aggregation pipeline to filter valid data at the database level
             pipeline = [
                 {
                     "$match": {
-                        "history": {"$exists": True, "$not": {"$size": 0}}
+                        "history.0": {"$exists": True}  # Non-empty history (index scan)
                     }
                 },
+            ]
+
+            if skip_stable:
+                low, high = STABLE_RATIO_BAND
+                pipeline += [
+                    {
+                        "$addFields": {
+                            "mean_last_7": {"$divide": [_sales_since(7, 0), 7]},
+                            "mean_prev_7": {"$divide": [_sales_since(14, 7), 7]}
+                        }
+                    },
+                    {
+                        "$match": {
+                            "$expr": {"$or": [
+                                # Never forecasted yet
+                                {"$eq": [{"$type": "$ai_forecast"}, "missing"]},
+                                # Stale: last analysis older than the TTL (missing last_analyzed sorts lowest)
+                                {"$lt": ["$last_analyzed", {"$subtract": ["$$NOW", FORECAST_TTL_DAYS * DAY_MS]}]},
+                                # Stored stock-out date has already passed
+                                {"$and": [
+                                    {"$eq": [{"$type": "$ai_forecast.stock_out_date"}, "string"]},
+                                    {"$lt": ["$ai_forecast.stock_out_date", {"$dateToString": {"format": "%Y-%m-%d", "date": "$$NOW"}}]}
+                                ]},
+                                # Trending: last week vs previous week outside the stable band
+                                {"$gt": ["$mean_last_7", {"$multiply": [high, "$mean_prev_7"]}]},
+                                {"$lt": ["$mean_last_7", {"$multiply": [low, "$mean_prev_7"]}]},
+                                # Low days-of-cover: quantity / mean_last_7 < threshold
+                                {"$lt": ["$quantity", {"$multiply": [DAYS_OF_COVER_THRESHOLD, "$mean_last_7"]}]}
+                            ]}
+                        }
+                    }
+                ]
+
+            pipeline += [
                 {
                     "$project": {
                         "_id": 1,
                         "name": 1,
                         "quantity": 1,
-                        "history": 1,
+                        # Only the fields the forecaster reads from each sales event
+                        "history": {
+                            "$map": {
+                                "input": "$history",
+                                "as": "h",
+                                "in": {
+                                    "d": {"$ifNull": ["$$h.date", "$$h.createdAt"]},
+                                    "y": {"$ifNull": ["$$h.sales", "$$h.quantity_sold"]}
+                                }
+                            }
+                        },
                         "category": 1
                     }
                 },
                 {"$limit": limit}
             ]
-            
-            products = list(self.db.products.aggregate(pipeline))
-            logger.info(f"📉 Fetched {len(products)} products for training batch.")
-            return products
+
+            count = 0
+            for product in self.db.products.aggregate(pipeline, batchSize=100, allowDiskUse=True):
+                count += 1
+                yield product
+            logger.info(f"📉 Streamed {count} products for training batch.")
         except Exception as e:
             logger.error(f"❌ Error fetching batch: {e}")
-            return []
+            raise  # A partial stream must not look like a complete batch
+
+    def _bulk_write_chunked(self, collection, operations: List[UpdateOne]) -> int:
+        """
+        Submits operations in fixed-size unordered slices to keep each BSON payload small.
+        Returns the total number of modified documents. Per-document write errors let the
+        remaining slices run and are re-raised at the end; any other error propagates at once.
+        """
+        modified = 0
+        write_error: Optional[BulkWriteError] = None
+        for start in range(0, len(operations), BULK_WRITE_CHUNK_SIZE):
+            chunk = operations[start:start + BULK_WRITE_CHUNK_SIZE]
+            try:
+                result = collection.bulk_write(chunk, ordered=False)
+                modified += result.modified_count
+            except BulkWriteError as bwe:
+                modified += bwe.details.get("nModified", 0)
+                logger.error(f"❌ Bulk Write Error: {bwe.details}")
+                write_error = write_error or bwe
+            except Exception as e:
+                logger.error(f"❌ General Write Error: {e}")
+                raise
+        if write_error is not None:
+            logger.error(f"❌ Bulk Write Incomplete: {modified} documents updated before errors.")
+            raise write_error
+        return modified
 
-    def bulk_update_predictions(self, updates: List[Dict[str, Any]]):
+    def bulk_update_predictions(self, updates: List[Dict[str, Any]]) -> int:
         """
         Performs a BULK WRITE operation. 
         Crucial for performance when updating thousands of records.
+        Returns the number of modified documents; raises if any write fails.
         """
         if not updates:
-            return
-
-        operations = []
-        for item in updates:
-            operations.append(
-                UpdateOne(
-                    {"_id": item["_id"]},
-                    {"$set": {
-                        "ai_forecast": item["prediction"],
-                        "last_analyzed": datetime.utcnow()
-                    }}
-                )
-            )
+            return 0
 
-        try:
-            result = self.db.products.bulk_write(operations, ordered=False)
-            logger.info(f"💾 Bulk Write Success: {result.modified_count} documents updated.")
-        except BulkWriteError as bwe:
-            logger.error(f"❌ Bulk Write Error: {bwe.details}")
-        except Exception as e:
-            logger.error(f"❌ General Write Error: {e}")
+        now = datetime.utcnow()  # One timestamp for the whole batch
+        operations = [
+            UpdateOne({"_id": item["_id"]}, {"$set": {"ai_forecast": item["prediction"], "last_analyzed": now}})
+            for item in updates
+        ]
+
+        modified = self._bulk_write_chunked(self.db.products, operations)
+        logger.info(f"💾 Bulk Write Complete: {modified} documents updated.")
+        return modified
+
+# Shared instance, created on first use so importing this module never blocks on Mongo
+_db: Optional[DBConnector] = None
+_db_lock = threading.Lock()
 
-# Export singleton instance
-db = DBConnector()
\ No newline at end of file
+def get_db() -> DBConnector:
+    """Returns the process-wide connector (one connection pool), connecting lazily."""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = DBConnector()
+        return _db
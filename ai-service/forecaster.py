@@ -1,11 +1,143 @@
+import os
+import copy
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
-from prophet import Prophet
 import logging
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from numba import njit, types
+from typing import Dict, Any, List, Optional, Tuple, Iterator
+
+try:
+    from prophet import Prophet
+except ImportError:  # Prophet is only needed when USE_PROPHET is enabled
+    Prophet = None
 
 logger = logging.getLogger("Forecaster_Engine")
 
+# Silence per-fit Prophet/Stan chatter
+logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+logging.getLogger("prophet").setLevel(logging.WARNING)
+
+# Model selection: Holt-Winters (fast, default) or Prophet (slow, fallback)
+USE_PROPHET = os.getenv("USE_PROPHET", "false").lower() == "true"
+FORECAST_HORIZON = 30  # Days
+MIN_HISTORY_DAYS = 10  # Require minimum data points
+MAX_HISTORY_DAYS = 730  # Only the most recent two years feed the model (bounds the batch matrix width)
+
+# Trivial series (flat or too sparse for seasonality) skip model fitting entirely
+FLAT_STD_EPS = 1e-6
+MIN_SALES_DAYS = 5
+
+# Forecast window: (first forecast day, yhat, yhat_lower, yhat_upper) as float32 arrays
+Window = Tuple[np.datetime64, np.ndarray, np.ndarray, np.ndarray]
+
+# Unfitted Prophet built once per process and copied for every fit
+# (module-level so it survives engine pickling into pool workers)
+_PROPHET_TEMPLATE = None
+
+# LRU cache of forecast windows keyed by (product_id, history hash).
+# Shared across requests so unchanged histories are never re-fitted.
+FORECAST_CACHE_SIZE = 5000
+_FORECAST_CACHE: "OrderedDict[Tuple[Any, bytes], Window]" = OrderedDict()
+_FORECAST_CACHE_LOCK = threading.Lock()
+
+# Holt-Winters smoothing parameters
+HW_ALPHA = 0.3   # Level
+HW_BETA = 0.05   # Trend
+HW_GAMMA = 0.1   # Seasonality
+HW_Z = 1.96      # 95% Confidence Interval
+
+# Explicit signatures: compiled (or loaded from the on-disk cache) at import, not on the first request.
+# Inputs are typed read-only so pandas' read-only views match too (writable arrays still do).
+_F4_IN = types.Array(types.float32, 1, 'A', readonly=True)
+_F8_OUT = types.Array(types.float64, 1, 'C')
+
+@njit(types.Tuple((_F8_OUT, _F8_OUT, _F8_OUT))(_F4_IN, types.int64, types.int64), cache=True, fastmath=True)
+def hw_forecast(y, horizon, season_len):
+    """
+    Additive Holt-Winters (level + trend + seasonality) with residual-std confidence bands.
+    Returns (yhat, yhat_lower, yhat_upper) for the next `horizon` steps.
+    """
+    n = y.shape[0]
+    m = season_len if n >= 2 * season_len else 1
+
+    # Initial state from the first two seasons
+    level = y[:m].mean()
+    trend = (y[m:2 * m].mean() - level) / m
+    season = np.empty(m)
+    for i in range(m):
+        season[i] = y[i] - level
+
+    # Smooth over the remaining history, tracking one-step-ahead errors
+    sse = 0.0
+    for t in range(m, n):
+        s = season[t % m]
+        err = y[t] - (level + trend + s)
+        sse += err * err
+
+        prev_level = level
+        level = HW_ALPHA * (y[t] - s) + (1.0 - HW_ALPHA) * (level + trend)
+        trend = HW_BETA * (level - prev_level) + (1.0 - HW_BETA) * trend
+        season[t % m] = HW_GAMMA * (y[t] - level) + (1.0 - HW_GAMMA) * s
+
+    sigma = np.sqrt(sse / (n - m)) if n > m else 0.0
+
+    yhat = np.empty(horizon)
+    yhat_lower = np.empty(horizon)
+    yhat_upper = np.empty(horizon)
+    for h in range(1, horizon + 1):
+        point = level + h * trend + season[(n + h - 1) % m]
+        width = HW_Z * sigma * np.sqrt(1.0 + (h - 1) * HW_ALPHA * HW_ALPHA)
+        yhat[h - 1] = point
+        yhat_lower[h - 1] = point - width
+        yhat_upper[h - 1] = point + width
+
+    return yhat, yhat_lower, yhat_upper
+
+# Trend codes returned by _reduce_forecast
+TREND_LABELS = {1: "uptrend", -1: "downtrend", 0: "stable"}
+
+@njit(types.Tuple((types.int64, types.int64, types.float64, types.float64))(_F4_IN, _F4_IN, _F4_IN, types.float64), cache=True)
+def _reduce_forecast(yhat, lower, upper, current_qty):
+    """
+    Single fused pass over a forecast window.
+    Returns (stock_out_idx, trend_code, avg_spread, predicted_demand);
+    stock_out_idx is -1 if stock lasts the whole window.
+    """
+    n = yhat.shape[0]
+    k = min(5, n)
+
+    stock_out_idx = -1
+    demand = 0.0
+    spread = 0.0
+    start_sales = 0.0
+    end_sales = 0.0
+    for i in range(n):
+        # Depletion: first day cumulative (non-negative) sales reach current stock
+        demand += max(yhat[i], 0.0)
+        if stock_out_idx < 0 and demand >= current_qty:
+            stock_out_idx = i
+
+        spread += upper[i] - lower[i]
+        if i < k:
+            start_sales += yhat[i]
+        if i >= n - k:
+            end_sales += yhat[i]
+
+    # Trend: compare first 5 days of forecast vs last 5 days
+    start_sales /= k
+    end_sales /= k
+    if end_sales > start_sales * 1.1:
+        trend_code = 1
+    elif end_sales < start_sales * 0.9:
+        trend_code = -1
+    else:
+        trend_code = 0
+
+    return stock_out_idx, trend_code, spread / n, demand
+
 class ForecasterEngine:
     def __init__(self):
         # Configuration for the model
@@ -13,109 +145,305 @@ class ForecasterEngine:
             'daily_seasonality': False,
             'weekly_seasonality': True,
             'yearly_seasonality': True,
-            'interval_width': 0.95  # 95% Confidence Interval
+            'interval_width': 0.95,  # 95% Confidence Interval
+            'mcmc_samples': 0,  # MAP fit only
+            'uncertainty_samples': 100  # Only the mean band width is used (default 1000)
         }
 
-    def _preprocess_data(self, history: List[Dict]) -> Optional[pd.DataFrame]:
+    def _preprocess_batch(self, products: List[Dict[str, Any]]) -> Tuple[List[Any], np.ndarray, np.ndarray, np.ndarray]:
         """
-        Cleans, standardizes, and fills gaps in time-series data.
+        Vectorized preprocessing for a whole batch of products.
+        Builds one dense (n_products x n_days) daily sales matrix in a single pass,
+        instead of a DataFrame + groupby + resample per product.
+        Returns (ids, y_matrix, start_dates, n_days); row i is valid up to n_days[i].
         """
-        try:
-            df = pd.DataFrame(history)
-            
-            # Normalize column names
-            # Map common variations to 'ds' and 'y'
-            col_map = {'date': 'ds', 'createdAt': 'ds', 'sales': 'y', 'quantity_sold': 'y'}
-            df.rename(columns=col_map, inplace=True)
-
-            # Ensure strict types
-            df['ds'] = pd.to_datetime(df['ds'])
-            df['y'] = pd.to_numeric(df['y'], errors='coerce').fillna(0)
-
-            # Drop invalid rows
-            df.dropna(subset=['ds', 'y'], inplace=True)
-            
-            # Aggregate duplicates (same day sales)
-            df = df.groupby('ds').sum().reset_index()
-
-            # Resample to ensure daily frequency (fill missing days with 0)
-            df.set_index('ds', inplace=True)
-            df = df.resample('D').sum().fillna(0).reset_index()
-
-            if len(df) < 10:  # Require minimum data points
-                logger.debug(f"Skipping: Insufficient data points ({len(df)})")
-                return None
-                
-            return df
-        except Exception as e:
-            logger.error(f"Preprocessing failed: {e}")
-            return None
+        ids = [p['_id'] for p in products]
+        n_products = len(products)
+
+        # Flatten all histories into (product index, date, sales) arrays
+        pid_idx, dates, sales = [], [], []
+        for i, p in enumerate(products):
+            history = p.get('history')
+            if not isinstance(history, list):
+                continue
+            for h in history:
+                if not isinstance(h, dict):
+                    continue  # Malformed event: skip it, not the whole batch
+                pid_idx.append(i)
+                # Compact {d, y} events from the training pipeline, or raw history entries
+                dates.append(h.get('d', h.get('date', h.get('createdAt'))))
+                sales.append(h.get('y', h.get('sales', h.get('quantity_sold'))))
+
+        pid_idx = np.asarray(pid_idx, dtype=np.int64)
+        # Parse per element (date-only, ISO "...Z", datetimes) in UTC, then drop the tz
+        days = pd.to_datetime(pd.Series(dates, dtype=object), errors='coerce', utc=True, format='mixed')
+        days = days.dt.tz_convert(None).to_numpy().astype('datetime64[D]')
+        y = pd.to_numeric(pd.Series(sales, dtype=object), errors='coerce').fillna(0).to_numpy(dtype=np.float32)
+
+        # Drop invalid rows
+        valid = ~np.isnat(days)
+        pid_idx, days, y = pid_idx[valid], days[valid], y[valid]
+
+        # Per-product date range (products without valid events keep n_days = 0).
+        # Events are flattened in product order, so each product is one contiguous segment.
+        day_num = days.astype(np.int64)
+        counts = np.bincount(pid_idx, minlength=n_products)
+        has_data = counts > 0
+        seg_starts = (np.cumsum(counts) - counts)[has_data]
+        start = np.zeros(n_products, dtype=np.int64)
+        end = np.zeros(n_products, dtype=np.int64)
+        start[has_data] = np.minimum.reduceat(day_num, seg_starts)
+        end[has_data] = np.maximum.reduceat(day_num, seg_starts)
+
+        # Clip each product to its last MAX_HISTORY_DAYS so one outlier date cannot widen every row
+        start = np.maximum(start, end - MAX_HISTORY_DAYS + 1)
+        recent = day_num >= start[pid_idx]
+        pid_idx, day_num, y = pid_idx[recent], day_num[recent], y[recent]
+        n_days = np.where(has_data, end - start + 1, 0)
+
+        # Aggregate same-day sales and fill missing days with 0 in one weighted bincount
+        width = int(n_days.max(initial=0))
+        flat_idx = pid_idx * width + (day_num - start[pid_idx])
+        y_matrix = np.bincount(flat_idx, weights=y, minlength=n_products * width)
+        y_matrix = y_matrix.reshape(n_products, width).astype(np.float32)
+
+        start_dates = np.where(has_data, start, 0).astype('datetime64[D]')
+        return ids, y_matrix, start_dates, n_days
+
+    def prepare_batch(self, products: List[Dict[str, Any]]) -> List[Tuple[Any, int, np.ndarray, np.datetime64]]:
+        """
+        Preprocesses a batch of product documents into (id, quantity, y, start_date) forecast tasks.
+        """
+        ids, y_matrix, start_dates, n_days = self._preprocess_batch(products)
+        return [
+            (pid, p.get('quantity', 0), y_matrix[i, :n_days[i]], start_dates[i])
+            for i, (pid, p) in enumerate(zip(ids, products))
+        ]
+
+    def _new_prophet(self) -> "Prophet":
+        """
+        Returns a fresh, unfitted Prophet model.
+        Copies a per-process template instead of re-running Prophet.__init__, so config
+        validation and Stan backend setup happen once. The backend is shared; containers
+        that fit() mutates in place are copied.
+        """
+        global _PROPHET_TEMPLATE
+        if _PROPHET_TEMPLATE is None:
+            _PROPHET_TEMPLATE = Prophet(**self.model_config)
+
+        m = copy.copy(_PROPHET_TEMPLATE)
+        m.seasonalities = copy.deepcopy(_PROPHET_TEMPLATE.seasonalities)
+        m.extra_regressors = copy.deepcopy(_PROPHET_TEMPLATE.extra_regressors)
+        m.history = None
+        m.history_dates = None
+        return m
+
+    def _predict_prophet(self, df: pd.DataFrame) -> Window:
+        """
+        Fits Prophet on the history and returns the forecast window.
+        """
+        if Prophet is None:
+            raise RuntimeError("USE_PROPHET is enabled but prophet is not installed.")
+
+        m = self._new_prophet()
+        m.fit(df)
+
+        future = m.make_future_dataframe(periods=FORECAST_HORIZON)
+        forecast = m.predict(future)
+
+        # Get last 30 days (prediction window), downcast to halve memory traffic
+        future_data = forecast.tail(FORECAST_HORIZON)
+        return (
+            future_data['ds'].iloc[0].to_datetime64().astype('datetime64[D]'),
+            future_data['yhat'].to_numpy(dtype=np.float32),
+            future_data['yhat_lower'].to_numpy(dtype=np.float32),
+            future_data['yhat_upper'].to_numpy(dtype=np.float32)
+        )
+
+    def _predict_holt_winters(self, y: np.ndarray, start_date: np.datetime64) -> Window:
+        """
+        Runs the JIT-compiled Holt-Winters model (weekly seasonality) and returns the forecast window.
+        """
+        yhat, yhat_lower, yhat_upper = hw_forecast(y.astype(np.float32, copy=False), FORECAST_HORIZON, 7)
+
+        first_day = np.datetime64(start_date, 'D') + len(y)
+        return first_day, yhat.astype(np.float32), yhat_lower.astype(np.float32), yhat_upper.astype(np.float32)
+
+    def predict_window(self, y: np.ndarray, start_date: np.datetime64) -> Window:
+        """
+        Trains the configured model and predicts the next 30 days.
+        """
+        if USE_PROPHET:
+            df = pd.DataFrame({'ds': pd.date_range(pd.Timestamp(start_date), periods=len(y), freq='D'), 'y': y})
+            return self._predict_prophet(df)
+        return self._predict_holt_winters(y, start_date)
+
+    def _cache_key(self, pid: Any, y: np.ndarray, start_date: np.datetime64) -> Tuple[Any, bytes]:
+        digest = hashlib.blake2b(np.ascontiguousarray(y, dtype=np.float32).tobytes(), digest_size=16)
+        digest.update(str(start_date).encode())
+        return pid, digest.digest()
+
+    def _cache_get(self, key: Tuple[Any, bytes]) -> Optional[Window]:
+        with _FORECAST_CACHE_LOCK:
+            window = _FORECAST_CACHE.get(key)
+            if window is not None:
+                _FORECAST_CACHE.move_to_end(key)
+            return window
+
+    def _cache_put(self, key: Tuple[Any, bytes], window: Window):
+        with _FORECAST_CACHE_LOCK:
+            _FORECAST_CACHE[key] = window
+            _FORECAST_CACHE.move_to_end(key)
+            while len(_FORECAST_CACHE) > FORECAST_CACHE_SIZE:
+                _FORECAST_CACHE.popitem(last=False)
+
+    def _series_records(self, first_day: np.datetime64, yhat: np.ndarray, yhat_lower: np.ndarray,
+                        yhat_upper: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Builds the 30-day `forecast_data` records (dates are only materialized here).
+        """
+        return [
+            {
+                "ds": pd.Timestamp(first_day + d),
+                "yhat": float(yhat[d]),
+                "yhat_lower": float(yhat_lower[d]),
+                "yhat_upper": float(yhat_upper[d])
+            }
+            for d in range(len(yhat))
+        ]
+
+    def _summarize(self, current_qty: int, window: Window, include_series: bool = True) -> Dict[str, Any]:
+        """
+        Derives depletion date, trend and confidence from a forecast window.
+        The 30-day series itself is only attached when `include_series` is set.
+        """
+        first_day, yhat, yhat_lower, yhat_upper = window
+
+        # 4-6. Stock depletion, trend & volatility in one JIT-compiled pass
+        stock_out_idx, trend_code, avg_spread, predicted_demand = _reduce_forecast(
+            yhat, yhat_lower, yhat_upper, float(current_qty)
+        )
+
+        stock_out_date = str(first_day + stock_out_idx) if stock_out_idx >= 0 else None
+        trend = TREND_LABELS[trend_code]
+
+        # Wide gap between yhat_upper and yhat_lower = High Volatility (Low Confidence)
+        confidence_score = "high" if avg_spread < (current_qty * 0.2) else "low"
+
+        prediction = {
+            "status": "success",
+            "stock_out_date": stock_out_date,
+            "predicted_monthly_demand": int(predicted_demand),
+            "trend": trend,
+            "confidence": confidence_score
+        }
+        if include_series:
+            prediction["forecast_data"] = self._series_records(*window)
+        return prediction
+
+    def _is_trivial(self, y: np.ndarray) -> bool:
+        return y.std() < FLAT_STD_EPS or np.count_nonzero(y > 0) < MIN_SALES_DAYS
+
+    def _trivial_forecast(self, current_qty: int, y: np.ndarray, start_date: np.datetime64,
+                          include_series: bool = True) -> Dict[str, Any]:
+        """
+        Constant-rate forecast for flat or sparse histories (no model fit).
+        """
+        daily_sales = float(y.mean())
+        spread = 2 * HW_Z * float(y.std())
+
+        # Depletion: first day cumulative sales at a constant rate reach current stock
+        stock_out_idx = max(int(np.ceil(current_qty / max(daily_sales, 1e-9))) - 1, 0)
+        first_day = np.datetime64(start_date, 'D') + len(y)
+        stock_out_date = str(first_day + stock_out_idx) if stock_out_idx < FORECAST_HORIZON else None
+
+        prediction = {
+            "status": "success",
+            "stock_out_date": stock_out_date,
+            "predicted_monthly_demand": round(daily_sales * FORECAST_HORIZON),
+            "trend": "stable",
+            "confidence": "high" if spread < (current_qty * 0.2) else "low"
+        }
+        if include_series:
+            yhat = np.full(FORECAST_HORIZON, daily_sales, dtype=np.float32)
+            prediction["forecast_data"] = self._series_records(first_day, yhat, yhat - spread / 2, yhat + spread / 2)
+        return prediction
 
     def generate_forecast(self, current_qty: int, history: List[Dict]) -> Dict[str, Any]:
         """
         Generates advanced inventory forecast with trend analysis and confidence scores.
+        Single-product wrapper over the batch pipeline (`prepare_batch` + `generate_batch`).
         """
-        df = self._preprocess_data(history)
-        if df is None:
-            return {"status": "insufficient_data"}
-
         try:
-            # 1. Initialize & Train Prophet
-            m = Prophet(**self.model_config)
-            m.fit(df)
-
-            # 2. Predict Future (30 Days)
-            future = m.make_future_dataframe(periods=30)
-            forecast = m.predict(future)
-
-            # 3. Extract Future Data
-            # Get last 30 days (prediction window)
-            future_data = forecast.tail(30)
-            
-            # 4. Advanced Logic: Stock Depletion Calculation
-            predicted_demand = future_data['yhat'].clip(lower=0).sum() # Prevent negative sales
-            
-            # Calculate depletion date
-            running_stock = current_qty
-            stock_out_date = None
-            
-            for _, row in future_data.iterrows():
-                daily_sales = max(0, row['yhat'])
-                running_stock -= daily_sales
-                
-                if running_stock <= 0:
-                    stock_out_date = row['ds'].strftime("%Y-%m-%d")
-                    break
-
-            # 5. Trend Analysis
-            # Compare first 5 days of forecast vs last 5 days
-            start_sales = future_data['yhat'].head(5).mean()
-            end_sales = future_data['yhat'].tail(5).mean()
-            
-            if end_sales > start_sales * 1.1:
-                trend = "uptrend"
-            elif end_sales < start_sales * 0.9:
-                trend = "downtrend"
-            else:
-                trend = "stable"
-
-            # 6. Confidence/Volatility Score
-            # Wide gap between yhat_upper and yhat_lower = High Volatility (Low Confidence)
-            avg_spread = (future_data['yhat_upper'] - future_data['yhat_lower']).mean()
-            confidence_score = "high" if avg_spread < (current_qty * 0.2) else "low"
-
-            return {
-                "status": "success",
-                "stock_out_date": stock_out_date,
-                "predicted_monthly_demand": int(predicted_demand),
-                "trend": trend,
-                "confidence": confidence_score,
-                "forecast_data": future_data[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(30).to_dict('records')
-            }
+            tasks = self.prepare_batch([{'_id': None, 'quantity': current_qty, 'history': history}])
+        except Exception as e:
+            logger.error(f"Preprocessing failed: {e}")
+            return {"status": "error", "message": str(e)}
 
+        _, prediction = next(self.generate_batch(tasks))
+        return prediction
+
+    def _predict_task(self, task: Tuple[np.ndarray, np.datetime64]) -> Tuple[Optional[Window], Optional[str]]:
+        """
+        Picklable entry point for worker processes: fits one series, returns (window, error).
+        """
+        try:
+            return self.predict_window(*task), None
         except Exception as e:
             logger.error(f"Model Training Failed: {e}")
-            return {"status": "error", "message": str(e)}
+            return None, str(e)
+
+    def generate_batch(self, tasks: List[Tuple[Any, int, np.ndarray, np.datetime64]], pool=None,
+                       include_series: bool = True) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        """
+        Forecasts tasks from `prepare_batch`, yielding (id, prediction).
+        Trivial series and cache lookups are handled here in the calling process; only
+        products whose history changed are fitted, in parallel when a process pool is given.
+        """
+        keys, windows, misses, trivial, errors = {}, {}, [], {}, {}
+        for i, (pid, current_qty, y, start_date) in enumerate(tasks):
+            if len(y) < MIN_HISTORY_DAYS:
+                continue
+            if self._is_trivial(y):
+                try:
+                    trivial[i] = self._trivial_forecast(current_qty, y, start_date, include_series)
+                except Exception as e:
+                    logger.error(f"Forecast Failed: {e}")
+                    errors[i] = str(e)
+                continue
+            key = keys[i] = self._cache_key(pid, y, start_date)
+            window = self._cache_get(key)
+            if window is None:
+                misses.append(i)
+            else:
+                windows[i] = window
+
+        # Fit only the cache misses
+        jobs = [(tasks[i][2], tasks[i][3]) for i in misses]
+        fitted = pool.map(self._predict_task, jobs, chunksize=8) if pool else map(self._predict_task, jobs)
+
+        for i, (window, error) in zip(misses, fitted):
+            if window is None:
+                errors[i] = error
+            else:
+                windows[i] = window
+                self._cache_put(keys[i], window)
+
+        for i, (pid, current_qty, y, _) in enumerate(tasks):
+            if i in trivial:
+                yield pid, trivial[i]
+            elif i in windows:
+                # One bad product (e.g. missing quantity) must not abort the batch
+                try:
+                    prediction = self._summarize(current_qty, windows[i], include_series)
+                except Exception as e:
+                    logger.error(f"Forecast Failed: {e}")
+                    prediction = {"status": "error", "message": str(e)}
+                yield pid, prediction
+            elif i in errors:
+                yield pid, {"status": "error", "message": errors[i]}
+            else:
+                yield pid, {"status": "insufficient_data"}
 
 # Export singleton
 engine = ForecasterEngine()
\ No newline at end of file
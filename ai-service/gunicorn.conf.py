@@ -0,0 +1,13 @@
+import os
+
+# Production WSGI config: `gunicorn app:app` picks this file up automatically.
+bind = f"0.0.0.0:{os.environ.get('PORT', 5002)}"
+
+# One worker process: batch job status lives in memory, and forecasting
+# already fans out across CPU cores through its own process pool.
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+# Long batch jobs run in background threads, but keep slow requests alive
+timeout = 600